@@ -0,0 +1,239 @@
+import argparse
+import concurrent.futures
+import http.server
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import psutil
+
+
+# --------------------------------------------------
+#    Corpus
+# --------------------------------------------------
+# every snippet writes below its own uuid so concurrent runs never collide in /tmp/
+SNIPPETS = {
+    'trivial': """
+__retval__ = 1
+""",
+
+    'pandas': """
+import numpy as np
+import pandas as pd
+df = pd.DataFrame({'group': np.arange(200000) % 100, 'value': np.random.rand(200000)})
+summary = df.groupby('group')['value'].agg(['mean', 'std', 'count'])
+__retval__ = {'summary': summary.head(10).to_dict(), 'large_frame': df.head(5000)}
+""",
+
+    'matplotlib_png': """
+import uuid
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+fig, ax = plt.subplots(figsize=(8, 5))
+ax.plot(range(1000), [i * i for i in range(1000)])
+path = f'/tmp/{uuid.uuid4().hex}.png'
+fig.savefig(path)
+plt.close(fig)
+__retval__ = path
+""",
+
+    'large_nested': """
+__retval__ = {f'key{i}': {'values': list(range(100)), 'label': f'item {i}', 'nested': [{'a': i, 'b': [i] * 10}] * 5}
+              for i in range(500)}
+""",
+
+    'tmp_files': """
+import os, uuid
+paths = []
+for i in range(20):
+    path = f'/tmp/{uuid.uuid4().hex}.txt'
+    with open(path, 'w') as f:
+        f.write('line\\n' * 1000)
+    paths.append(path)
+for i in range(2):
+    d = f'/tmp/{uuid.uuid4().hex}'
+    os.makedirs(d)
+    for j in range(10):
+        with open(os.path.join(d, f'{j}.txt'), 'w') as f:
+            f.write('x' * 10000)
+    paths.append(d)
+__retval__ = paths
+""",
+}
+
+
+# --------------------------------------------------
+#    Stand-in Monitor
+# --------------------------------------------------
+class MonitorHandler(http.server.BaseHTTPRequestHandler):
+    """ accepts and acknowledges update_monitor requests like the monitoring webapp does, without rendering anything """
+    updates = 0
+
+    def _ok(self, applied: int):
+        MonitorHandler.updates += applied
+        body = json.dumps({'applied': applied}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._ok(1)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8', 'replace')
+        self._ok(len(json.loads(urllib.parse.parse_qs(body)['updates'][0])))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_monitor() -> str:
+    """ start the stand-in monitor on a free port and return its url """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MonitorHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='monitor', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+# --------------------------------------------------
+#    Measurement
+# --------------------------------------------------
+class RSSSampler:
+    """ samples the RSS of this process and all of its children, keeping the peak """
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss_sampler', daemon=True)
+
+    def _run(self):
+        me = psutil.Process()
+        while not self._stop.is_set():
+            rss = 0
+            for p in [me] + me.children(recursive=True):
+                try:
+                    rss += p.memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+            self.peak = max(self.peak, rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def percentile(values: list, p: float) -> float:
+    """ nearest rank percentile of a list of numbers """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def run_snippet(actions, code: str) -> tuple:
+    """ run one snippet through exec_python_code, returns (latency in seconds, error or None) """
+    start = time.perf_counter()
+    try:
+        d = actions.exec_python_code(code)
+        error = d['body'][:200] if d['content-type'] == 'text/error' else None
+    except Exception as e:
+        error = repr(e)
+    return time.perf_counter() - start, error
+
+
+def benchmark(actions, name: str, code: str, iterations: int, concurrency: int, warmup: int) -> dict:
+    """ run a snippet `iterations` times with `concurrency` calls in flight, returns its statistics """
+    for _ in range(warmup):
+        run_snippet(actions, code)
+
+    with RSSSampler() as sampler, concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(lambda _: run_snippet(actions, code), range(iterations)))
+        elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _ in results]
+    errors = [error for _, error in results if error is not None]
+    if errors:
+        logging.warning(f'{name}: {len(errors)} errors, first: {errors[0]}')
+    return {'snippet': name,
+            'iterations': iterations,
+            'concurrency': concurrency,
+            'errors': len(errors),
+            'throughput_per_sec': iterations / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p90_ms': percentile(latencies, 90) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': max(latencies) * 1000,
+            'peak_rss_mb': sampler.peak / 1024 / 1024}
+
+
+def print_table(rows: list):
+    columns = ['snippet', 'errors', 'throughput_per_sec', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'peak_rss_mb']
+    print(' '.join(f'{c:>18}' for c in columns))
+    for row in rows:
+        print(' '.join(f'{row[c]:>18.2f}' if isinstance(row[c], float) else f'{row[c]:>18}' for c in columns))
+
+
+# --------------------------------------------------
+#    Main
+# --------------------------------------------------
+def console_entry():
+    # handle the command line arguments
+    parser = argparse.ArgumentParser(description='Benchmark exec_python_code with a corpus of representative snippets')
+    parser.add_argument('--snippets', required=False, default=','.join(SNIPPETS),
+                        help=f'comma separated snippets to run, from {", ".join(SNIPPETS)}')
+    parser.add_argument('--iterations', type=int, required=False, default=50)
+    parser.add_argument('--concurrency', type=int, required=False, default=4)
+    parser.add_argument('--warmup', type=int, required=False, default=2)
+    parser.add_argument('--pool_size', type=int, required=False, default=None,
+                        help='size of the worker pool, defaults to [Execution] pool_size from the conf file')
+    parser.add_argument('--json', required=False, default='', help='also write the results to this json file')
+    parser.add_argument('--log_level', required=False, default='WARNING')
+    args = vars(parser.parse_args())
+
+    # setup the logger before the actions module configures its own
+    logging.basicConfig(level=args['log_level'], format='%(relativeCreated)6d %(threadName)s %(message)s')
+    from chatgpt_awesome_actions_datamodules import actions
+
+    # publish into a scratch directory and report to the stand-in monitor so the run is offline
+    save_dir = tempfile.mkdtemp(prefix='chatgpt_awesome_actions_benchmark_')
+    actions.SAVE_FILE_DIR = save_dir
+    actions.URL_PREFIX = 'http://localhost/generated_files'
+    actions.MONITOR_URL_PREFIX = start_monitor()
+    actions.RETENTION_TTL_HOURS = actions.RETENTION_MAX_BYTES = 0
+
+    # the pool forked at import still has the settings above from the conf file, replace it
+    if actions._EXEC_POOL is not None:
+        actions._EXEC_POOL.stop()
+    pool_size = actions.EXEC_POOL_SIZE if args['pool_size'] is None else args['pool_size']
+    actions._EXEC_POOL = None if pool_size <= 0 else actions._ExecPool(
+        pool_size, actions.EXEC_PRELOAD_MODULES, actions.EXEC_MAX_JOBS_PER_WORKER, actions.EXEC_MAX_WORKER_RSS_MB)
+
+    try:
+        rows = []
+        for name in map(str.strip, args['snippets'].split(',')):
+            if name not in SNIPPETS:
+                parser.error(f'unknown snippet {name}')
+            rows.append(benchmark(actions, name, SNIPPETS[name], args['iterations'], args['concurrency'], args['warmup']))
+        print_table(rows)
+        print(f'\nmonitor updates received: {MonitorHandler.updates}')
+        if args['json']:
+            with open(args['json'], 'w') as f:
+                json.dump(rows, f, indent=4)
+    finally:
+        shutil.rmtree(save_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    console_entry()
@@ -1,8 +1,16 @@
 import argparse
+import hashlib
+import json
 import logging
 import html
+import math
 import os
-from urllib.parse import urlparse, parse_qs
+import queue
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse, parse_qs, quote
 from datetime import datetime
 import pytz
 from pygments import highlight
@@ -16,39 +24,197 @@ class FIFODict(OrderedDict):
     def __init__(self, max_size=5, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.max_size = max_size
+        self.evicted = []
 
     def __setitem__(self, key, value):
-        if len(self) >= self.max_size:
-            self.popitem(last=False)  # Remove the oldest (FIFO)
+        if key not in self and len(self) >= self.max_size:
+            evicted_key, _ = self.popitem(last=False)  # Remove the oldest (FIFO)
+            self.evicted.append(evicted_key)
         super().__setitem__(key, value)
 
-    def __contains__(self, key):
-        """Allows checking if a key exists using 'key in fifo_dict'"""
-        return key in self.keys()
+
+class HistoryStore:
+    """ On-disk SQLite store of every execution seen by the monitor, bounded to max_rows rows """
+    def __init__(self, path, max_rows):
+        self.max_rows = max_rows
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS executions (
+                                  id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                  uid TEXT UNIQUE,
+                                  created REAL,
+                                  code_time REAL, code TEXT,
+                                  retval_time REAL, retval TEXT)""")
+        self._conn.execute('CREATE INDEX IF NOT EXISTS executions_created ON executions (created)')
+        self._conn.commit()
+
+    def save(self, rows):
+        """ insert or update the given {uid: row} rows and drop the oldest rows beyond max_rows """
+        with self._lock, self._conn:
+            for uid, value in rows.items():
+                self._conn.execute("""INSERT INTO executions (uid, created, code_time, code, retval_time, retval)
+                                      VALUES (?, ?, ?, ?, ?, ?)
+                                      ON CONFLICT(uid) DO UPDATE SET code_time=excluded.code_time, code=excluded.code,
+                                                                     retval_time=excluded.retval_time, retval=excluded.retval""",
+                                   (uid, time.time(), value['code']['time'], value['code']['s'],
+                                    value['retval']['time'], value['retval']['s']))
+            self._conn.execute('DELETE FROM executions WHERE id <= (SELECT MAX(id) FROM executions) - ?', (self.max_rows, ))
+
+    def query(self, uid=None, before=None, page=0, page_size=20):
+        """ return (uid, created, row) tuples, newest first, for one uid or one page of history """
+        sql = 'SELECT uid, created, code_time, code, retval_time, retval FROM executions'
+        if uid is not None:
+            sql, args = sql + ' WHERE uid = ?', [uid]
+        elif before is not None:
+            sql, args = sql + ' WHERE created < ? ORDER BY created DESC LIMIT ? OFFSET ?', [before, page_size, page * page_size]
+        else:
+            sql, args = sql + ' ORDER BY id DESC LIMIT ? OFFSET ?', [page_size, page * page_size]
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [(r[0], r[1], {'code': {'time': r[2], 's': r[3]}, 'retval': {'time': r[4], 's': r[5]}}) for r in rows]
 
 
 row_values = FIFODict(max_size=10)
+row_lock = threading.Lock()
+history = None
+
+# pygments objects are reused, the stylesheet is served once as pygments.css
+LEXER = PythonLexer()
+FORMATTER = HtmlFormatter(style="colorful", nowrap=True)  # Keep formatting inside div
+PYGMENTS_CSS = HtmlFormatter(style="colorful").get_style_defs('.highlight')
+HIGHLIGHT_CACHE = OrderedDict()
+HIGHLIGHT_CACHE_SIZE = 256
+OUTPUT_MAX_CHARS = 65536  # newest characters of each row's printed output which are kept
+highlight_lock = threading.Lock()
+highlight_queue = queue.Queue()
+
+
+def cached_python_to_html(code):
+    """ return the memoized highlighted html for code, or None if it has not been highlighted yet """
+    key = hashlib.sha1(code.encode('utf-8', 'surrogatepass')).hexdigest()
+    with highlight_lock:
+        if key in HIGHLIGHT_CACHE:
+            HIGHLIGHT_CACHE.move_to_end(key)
+            return HIGHLIGHT_CACHE[key]
+    return None
+
 
 def python_to_html(code):
     """Convert Python code to syntax-highlighted HTML while preserving line breaks."""
-    formatter = HtmlFormatter(style="colorful", nowrap=True)  # Keep formatting inside div
-    highlighted_code = highlight(code, PythonLexer(), formatter)
+    cached = cached_python_to_html(code)
+    if cached is not None:
+        return cached
 
-    # Get CSS styles for Pygments
-    css = HtmlFormatter(style="colorful").get_style_defs('.highlight')
+    highlighted_code = highlight(code, LEXER, FORMATTER)
 
     # Wrap output in <pre> to preserve line breaks
-    return f'<style>{css}</style><pre class="highlight">{highlighted_code}</pre>'
+    s = f'<pre class="highlight">{highlighted_code}</pre>'
+
+    key = hashlib.sha1(code.encode('utf-8', 'surrogatepass')).hexdigest()
+    with highlight_lock:
+        HIGHLIGHT_CACHE[key] = s
+        while len(HIGHLIGHT_CACHE) > HIGHLIGHT_CACHE_SIZE:
+            HIGHLIGHT_CACHE.popitem(last=False)
+    return s
+
+
+def highlighter_thread():
+    """ highlights code in the background and swaps it into the row in place of the plain text placeholder """
+    while True:
+        uid, code, placeholder = highlight_queue.get()
+        try:
+            highlighted = python_to_html(code)
+            with row_lock:
+                row = row_values.get(uid)
+                if row is None or placeholder not in row['code']['s']:
+                    continue
+                row['code']['s'] = row['code']['s'].replace(placeholder, highlighted, 1)
+                js = f'upsert_row({json.dumps(row_id(uid))}, {json.dumps(row_html(row))});'
+                rows = {uid: row}
+            if history is not None:
+                history.save(rows)
+            broadcast_js(js)
+        except Exception as e:
+            logging.exception(e)
+
+
+def row_id(uid):
+    """ DOM id of the table row for a uid """
+    return 'row_' + re.sub(r'[^A-Za-z0-9_-]', '_', uid)
+
+
+def row_html(value):
+    """ inner html of a table row """
+    output = value.get('output', '')
+    output_html = f'<pre class=output>{html.escape(output)}</pre>' if output else ''
+    return f'<td>{value["code"]["s"]}</td><td>{value["retval"]["s"]}{output_html}</td>'
+
+
+def table_html():
+    """ html of the whole table, newest row first, used to initialize a new page """
+    html = '<table><tbody id=code_retval_rows>'
+    with row_lock:
+        items = list(row_values.items())[::-1]
+    for uid, value in items:
+        html += f'<tr id={row_id(uid)}>{row_html(value)}</tr>'
+    html += '</tbody></table>'
+    return html
 
 
 def ready(jsc, *args):
     """ called when a webpage creates a new connection the first time on load """
     print('Ready', args)
+    jsc['#code_retval'].html = table_html()
 
 
 def reconnect(jsc, *args):
     """ called when a webpage automatically reconnects a broken connection """
     print('Reconnect', args)
+    jsc['#code_retval'].html = table_html()
+
+
+def broadcast_js(js):
+    """ run javascript on every connected monitor page """
+    for bjsc in get_broadcast_jsclients('/'):
+        try:
+            bjsc.eval_js_code(js, blocking=False)
+        except Exception as e:
+            logging.exception(e)
+
+
+def apply_update(uid, target, value, value_time, append=False):
+    """
+    store one update from the actions service in row_values, returns False if the update only
+    appended text to a row which already existed, so the page can append it instead of redrawing the row
+    """
+    if append and target == 'output':
+        if uid in row_values:
+            row = row_values[uid]
+            row['output'] = (row.get('output', '') + value)[-OUTPUT_MAX_CHARS:]
+            return False
+        row_values[uid] = {'code': {'time': 0, 's': ''}, 'retval': {'time': 0, 's': ''}, 'output': value[-OUTPUT_MAX_CHARS:]}
+        return True
+
+    if target == 'code':
+        # highlighting is slow for large snippets, show plain text until the highlighter thread is done
+        highlighted = cached_python_to_html(value)
+        if highlighted is None:
+            placeholder = f'<pre class="highlight">{html.escape(value)}</pre>'
+            highlight_queue.put((uid, value, placeholder))
+            highlighted = placeholder
+        value = highlighted
+
+    s = datetime.now(pytz.timezone("America/Los_Angeles")).strftime("%Y-%m-%d %H:%M:%S %Z")
+    value = f'<div style="background-color: yellow">{s} - {uid.partition(":")[0]}</div>{value}'
+
+    if uid not in row_values:
+        row_values[uid] = {'code': {'time': 0, 's': ''}, 'retval': {'time': 0, 's': ''}}
+    if float(value_time) > row_values[uid][target]['time']:
+        row_values[uid][target] = {'time': float(value_time), 's': value}
+    return True
 
 
 def handle_404(path, uri, *args):
@@ -58,40 +224,103 @@ def handle_404(path, uri, *args):
         parsed_url = urlparse(uri)
         params = parse_qs(parsed_url.query)
 
-        if ('uid' in params) and ('target' in params) and ('value' in params):
-            uid = params.get('uid', ['?'])[0]
-            target = params.get('target', ['?'])[0]
-            value = params.get('value', ['?'])[0]
-            value_time = params.get('time', 0)[0]
-
-            if target == 'code':
-                value = python_to_html(value)
-
-            s = datetime.now(pytz.timezone("America/Los_Angeles")).strftime("%Y-%m-%d %H:%M:%S %Z")
-            value = f'<div style="background-color: yellow">{s} - {uid.partition(":")[0]}</div>{value}'
-
-            if uid not in row_values:
-                row_values[uid] = {'code': {'time': 0, 's': ''}, 'retval': {'time': 0, 's': ''}}
-            if float(value_time) > row_values[uid][target]['time']:
-                row_values[uid][target] = {'time': float(value_time), 's': value}
-
-            # build the table
-            html = '<table>'
-            for _, value in list(row_values.items())[::-1]:
-                html += f'<tr><td>{value["code"]["s"]}</td><td>{value["retval"]["s"]}</td></tr>'
-            html += '<table>'
-
-            for bjsc in get_broadcast_jsclients('/'):
-                try:
-                    bjsc['#code_retval'].html = html
-                except Exception as e:
-                    logging.exception(e)
+        # batches of updates are POSTed as a form encoded body
+        for arg in args:
+            if isinstance(arg, bytes):
+                arg = arg.decode('utf-8', 'replace')
+            if isinstance(arg, str) and 'updates=' in arg:
+                params.update(parse_qs(arg))
+
+        if 'updates' in params:
+            updates = json.loads(params['updates'][0])
+        elif ('uid' in params) and ('target' in params) and ('value' in params):
+            updates = [{'uid': params.get('uid', ['?'])[0],
+                        'target': params.get('target', ['?'])[0],
+                        'value': params.get('value', ['?'])[0],
+                        'time': params.get('time', [0])[0],
+                        'append': params.get('append', [''])[0] in ('True', 'true', '1')}]
         else:
             logging.info('Missing target or value')
+            updates = []
+
+        with row_lock:
+            redraw = set()
+            appended = OrderedDict()
+            for u in updates:
+                if apply_update(u['uid'], u['target'], u['value'], u.get('time', 0), u.get('append', False)):
+                    redraw.add(u['uid'])
+                else:
+                    appended[u['uid']] = appended.get(u['uid'], '') + u['value']
+            rows = {uid: row_values[uid] for uid in dict.fromkeys(u['uid'] for u in updates) if uid in row_values}
+
+            # push only the rows which changed or were evicted, and only the new text of printed output
+            js = ''
+            for uid, row in rows.items():
+                if uid in redraw:
+                    js += f'upsert_row({json.dumps(row_id(uid))}, {json.dumps(row_html(row))});'
+                else:
+                    js += f'append_output({json.dumps(row_id(uid))}, {json.dumps(appended[uid][-OUTPUT_MAX_CHARS:])}, {OUTPUT_MAX_CHARS});'
+            for uid in row_values.evicted:
+                js += f'remove_row({json.dumps(row_id(uid))});'
+            row_values.evicted.clear()
+
+        if history is not None and rows:
+            try:
+                history.save(rows)
+            except Exception as e:
+                logging.exception(e)
+
+        if js:
+            broadcast_js(js)
+
+        # the actions service falls back to GET unless a POSTed batch is acknowledged in full
+        return (json.dumps({'applied': len(updates)}), 'application/json', 200)
+
+    elif path == 'pygments.css':
+        return (PYGMENTS_CSS, 'text/css', 200)
+
+    elif path == 'history':
+        return (history_html(parse_qs(urlparse(uri).query)), 'text/html', 200)
 
     return ('OK', 'text/plain', 200)
 
 
+def query_number(params, name, cast, default):
+    """ a numeric query parameter, or default if it is missing or not a finite number """
+    try:
+        value = cast(params[name][0])
+    except (KeyError, IndexError, ValueError, OverflowError):
+        return default
+    return value if math.isfinite(value) else default
+
+
+def history_html(params):
+    """ paged view of the persisted history, optionally filtered by uid or to rows before a unix time """
+    if history is None:
+        return '<h1>History is disabled</h1>'
+
+    uid = params.get('uid', [None])[0]
+    before = query_number(params, 'before', float, None)
+    page = max(0, query_number(params, 'page', int, 0))
+    page_size = min(200, max(1, query_number(params, 'page_size', int, 20)))
+    rows = history.query(uid=uid, before=before, page=page, page_size=page_size)
+
+    s = '<link rel="stylesheet" href="pygments.css"><h1>ChatGPT Awesome Actions Monitor History</h1><table>'
+    for row_uid, created, value in rows:
+        created_s = datetime.fromtimestamp(created, pytz.timezone("America/Los_Angeles")).strftime("%Y-%m-%d %H:%M:%S %Z")
+        s += f'<tr><td colspan=2><a href="history?uid={quote(row_uid)}">{html.escape(row_uid)}</a> {created_s}</td></tr>'
+        s += f'<tr>{row_html(value)}</tr>'
+    s += '</table>'
+
+    if uid is None:
+        extra = '' if before is None else f'&before={before}'
+        if page > 0:
+            s += f'<a href="history?page={page - 1}&page_size={page_size}{extra}">Newer</a> '
+        if len(rows) == page_size:
+            s += f'<a href="history?page={page + 1}&page_size={page_size}{extra}">Older</a>'
+    return s
+
+
 # --------------------------------------------------
 #    Main
 # --------------------------------------------------
@@ -102,8 +331,25 @@ def console_entry():
     # handle the --port argument
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', type=int, required=False, default=8300)
+    parser.add_argument('--history_db', required=False, default='/var/lib/chatgpt_awesome_actions/monitor_history.sqlite',
+                        help='sqlite file to persist executions in, empty to disable')
+    parser.add_argument('--history_max_rows', type=int, required=False, default=100000)
     args = vars(parser.parse_args())
 
+    # open the history and restore the live view from it
+    global history
+    if args['history_db']:
+        try:
+            history = HistoryStore(args['history_db'], args['history_max_rows'])
+            for uid, _, value in history.query(page_size=row_values.max_size)[::-1]:
+                row_values[uid] = value
+            row_values.evicted.clear()
+        except Exception as e:
+            logging.exception(e)
+            history = None
+
+    threading.Thread(target=highlighter_thread, name='highlighter', daemon=True).start()
+
     # run the app
     run_pylinkjs_app(default_html='webapp_chatgpt_awesome_actions_monitoring.html',
                      html_dir=os.path.dirname(__file__),
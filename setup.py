@@ -9,13 +9,14 @@ def read_requirements():
 setup(name='chatgpt_awesome_actions',
       version='1.0.0',
       description='ChatGPT Awesome Actions',
-      packages=['chatgpt_awesome_actions_datamodules', 'chatgpt_awesome_actions_monitoring_webapp'],
+      packages=['chatgpt_awesome_actions_datamodules', 'chatgpt_awesome_actions_monitoring_webapp', 'chatgpt_awesome_actions_benchmark'],
       install_requires=read_requirements(),
       package_data={
         "chatgpt_awesome_actions_datamodules": ["_static/**/*"],  # Include all files inside _static
         "chatgpt_awesome_actions_monitoring_webapp": ["*.html"],  # Includes all .html files in this package
       },
       entry_points={
-        'console_scripts': ['chatgpt_awesome_actions_monitor=chatgpt_awesome_actions_monitoring_webapp.webapp_chatgpt_awesome_actions_monitoring:console_entry'],
+        'console_scripts': ['chatgpt_awesome_actions_monitor=chatgpt_awesome_actions_monitoring_webapp.webapp_chatgpt_awesome_actions_monitoring:console_entry',
+                            'chatgpt_awesome_actions_benchmark=chatgpt_awesome_actions_benchmark.benchmark:console_entry'],
         }      
 )